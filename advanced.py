@@ -71,6 +71,9 @@
 # MAGIC * Concurrency: Sets the level of concurrency, indicating how many queries can be executed simultaneously.
 # MAGIC * Maximum Clusters: Specifies the maximum number of clusters that the warehouse can be scaled up to. It is recommended to use 1 cluster for every 10 concurrent queries.
 # MAGIC * Result Cache Enabled (default: False): Determines whether the query will be served from the result cache.
+# MAGIC * Warmup Iterations (default: 1): Number of times each query is executed before the measured run. Warm-up results are discarded and excluded from the benchmark metrics.
+# MAGIC * Benchmark Mode (default: warm): "cold" disables the result cache and clears the cache after every query, "lukewarm" clears the cache once at the start of the benchmark, "warm" pre-warms tables and runs the warm-up iterations.
+# MAGIC * Warmup Plans (default: True): In warm mode, run `EXPLAIN FORMATTED` for each query before the measured run to prime query planning.
 
 # COMMAND ----------
 
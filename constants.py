@@ -107,6 +107,9 @@ _WIDGETS_BASE = [
     ("dropdown", ("Max Clusters", "1", [str(x) for x in range(1, 41)])),
     ("dropdown", ("Disk Cache Enabled", "True", ["True", "False"])),
     ("dropdown", ("Results Cache Enabled", "False", ["True", "False"])),
+    ("dropdown", ("Warmup Iterations", "1", [str(x) for x in range(0, 11)])),
+    ("dropdown", ("Benchmark Mode", "warm", ["cold", "lukewarm", "warm"])),
+    ("dropdown", ("Warmup Plans", "True", ["True", "False"])),
 ]
 
 # Use _WIDGETS in advanced notebook 
@@ -216,6 +219,15 @@ class Constants:
     # Size of the warehouse cluster
     warehouse_sizes: str
 
+    # Number of times each query is executed before the measured run
+    warmup_iterations: int
+
+    # Cache state of the warehouse during the measured run: cold, lukewarm or warm
+    benchmark_mode: str
+
+    # Run EXPLAIN FORMATTED for each query before the measured run in warm mode
+    warmup_plans: bool
+
     # # Warehouse channel name
     # channel: str
 
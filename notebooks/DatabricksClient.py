@@ -138,6 +138,9 @@ class DatabricksClient:
                     "max_clusters": self.constants.max_clusters,
                     "results_cache_enabled": self.constants.results_cache_enabled,
                     "disk_cache_enabled": self.constants.disk_cache_enabled,
+                    "warmup_iterations": self.constants.warmup_iterations,
+                    "benchmark_mode": self.constants.benchmark_mode,
+                    "warmup_plans": self.constants.warmup_plans,
                 },
             },
             # "job_cluster_key": "metimur_cluster",
@@ -52,6 +52,12 @@
 # MAGIC * Concurrency: Sets the level of concurrency, indicating how many queries can be executed simultaneously.
 # MAGIC * Maximum Clusters: Specifies the maximum number of clusters that the warehouse can be scaled up to. It is recommended to use 1 cluster for every 10 concurrent queries.
 # MAGIC * Result Cache Enabled (default: False): Determines whether the query will be served from the result cache.
+# MAGIC * Warmup Iterations (default: 1): Number of times each query is executed before the measured run. Warm-up results are discarded and excluded from the benchmark metrics.
+# MAGIC * Benchmark Mode (default: warm): Controls the cache state of the warehouse while the queries are measured.
+# MAGIC   * cold: Result cache is disabled and the cache is cleared after every query. Tables are not pre-warmed and warm-up iterations are skipped.
+# MAGIC   * lukewarm: The cache is cleared once at the start of the benchmark. Tables are not pre-warmed and warm-up iterations are skipped.
+# MAGIC   * warm: Tables are pre-warmed (if disk cache is enabled) and each query runs `warmup_iterations` times before the measured run.
+# MAGIC * Warmup Plans (default: True): In warm mode, run `EXPLAIN FORMATTED` for each query before the measured run, so the warehouse plans the queries and loads table metadata without executing them.
 
 # COMMAND ----------
 
@@ -66,16 +72,26 @@
 # COMMAND ----------
 
 import pandas as pd
+import pyarrow as pa
+import plotly.express as px
 import logging
 from beaker import benchmark, spark_fixture, sqlwarehouseutils
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from databricks.sdk import WorkspaceClient
+from databricks.sdk.service.sql import QueryMetrics
+from dataclasses import fields
+from functools import lru_cache
+from typing import get_args, get_type_hints
+import json
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import re
 from pyspark.sql.functions import lit
 
 spark.conf.set("spark.databricks.delta.optimizeWrite.enabled", "true")
+# Convert the metrics pandas DataFrame to Spark in Arrow batches rather than row by row
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
 
 # COMMAND ----------
 
@@ -88,6 +104,10 @@ logger = logging.getLogger()
 HOSTNAME = spark.conf.get('spark.databricks.workspaceUrl')
 TOKEN = WorkspaceClient().tokens.create(comment='temp use', lifetime_seconds=60*60*12).token_value
 
+# Shared HTTP session, warehouse API calls reuse pooled connections instead of opening a new TLS connection each time
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
 VALID_WAREHOUSES = ["2X-Small", "X-Small", "Small", "Medium", "Large", "X-Large", "2X-Large", "3X-Large", "4X-Large"]
 
 # COMMAND ----------
@@ -111,6 +131,9 @@ dbutils.widgets.text(name="min_clusters", defaultValue="1", label="10. min_clust
 dbutils.widgets.text(name="max_clusters", defaultValue="1", label="11. max_clusters")
 dbutils.widgets.dropdown(name="results_cache_enabled", defaultValue="False", choices = ["True", "False"], label="12. results_cache_enabled")
 dbutils.widgets.dropdown(name="disk_cache_enabled", defaultValue="True", choices = ["True", "False"], label="13. disk_cache_enabled")
+dbutils.widgets.dropdown(name="warmup_iterations", defaultValue="1", choices=[str(x) for x in range(0,11)], label="14. warmup_iterations")
+dbutils.widgets.dropdown(name="benchmark_mode", defaultValue="warm", choices=["cold", "lukewarm", "warm"], label="15. benchmark_mode")
+dbutils.widgets.dropdown(name="warmup_plans", defaultValue="True", choices=["True", "False"], label="16. warmup_plans")
 
 # COMMAND ----------
 
@@ -119,9 +142,9 @@ widgets = dbutils.widgets.getAll()
 
 # Create variables with the same names as the widget names and assign their values
 for name, value in widgets.items():
-    if name in ["query_repetition_count", "concurrency", "min_clusters", "max_clusters"]:
+    if name in ["query_repetition_count", "concurrency", "min_clusters", "max_clusters", "warmup_iterations"]:
         exec(f"{name} = int('{value}')")
-    elif name in ["results_cache_enabled", "disk_cache_enabled"]:
+    elif name in ["results_cache_enabled", "disk_cache_enabled", "warmup_plans"]:
         exec(f"{name} = True if '{value}' in ('True', 'true') else False")
     else:
         exec(f"{name} = '{value}'")
@@ -137,8 +160,10 @@ for name, value in widgets.items():
 
 # COMMAND ----------
 
-warehouse_sizes = warehouse_sizes.split(",")
-warehouse_size = warehouse_sizes[0]
+# Parse the multiselect widget once from its raw value, so re-running this cell doesn't split an already split value
+all_warehouse_sizes = tuple(size.strip() for size in widgets["warehouse_sizes"].split(","))
+warehouse_size = all_warehouse_sizes[0]
+warehouse_sizes = all_warehouse_sizes if benchmark_choice == "multiple-warehouses-size" else (warehouse_size,)
 if benchmark_choice == "multiple-warehouses-size":
   print("Benchmark on multiple warehouse sizes:", warehouse_sizes)
 elif benchmark_choice == "multiple-warehouses":
@@ -149,31 +174,33 @@ elif benchmark_choice == "one-warehouse":
 
 # COMMAND ----------
 
-# tables = spark.sql(f"show tables in {catalog_name}.{schema_name}").select("tableName").collect()
-# tables = [row["tableName"] for row in tables]
-# tables
-
-### List all tables under catalog_name.schema_name using spark.catalog.X api in DBR 14.2 or later
-tables_list = spark.catalog.listTables(f"{catalog_name}.{schema_name}")
-tables = [table.name for table in tables_list]
+### List all tables under catalog_name.schema_name, SHOW TABLES only reads table names from the metastore
+tables = spark.sql(f"SHOW TABLES IN `{catalog_name}`.`{schema_name}`").select("tableName").collect()
+tables = [row["tableName"] for row in tables]
 tables
 
 # COMMAND ----------
 
-def get_warehouse(hostname, token, warehouse_name):
+@lru_cache(maxsize=1)
+def list_warehouses(hostname, token):
+  """
+  Map warehouse names to ids with a single API call, shared by all benchmarks.
+  Call `list_warehouses.cache_clear()` to refresh the list.
+  """
   sql_warehouse_url = f"https://{hostname}/api/2.0/sql/warehouses"
-  response = requests.get(sql_warehouse_url, headers={"Authorization": f"Bearer {token}"})
-  
-  if response.status_code == 200:
-    for warehouse in response.json()['warehouses']:
-      if warehouse['name'] == warehouse_name:
-        return(warehouse['id'])
-  else:
-    print(f"Error: {response.json()['error_code']}, {response.json()['message']}")
+  response = SESSION.get(sql_warehouse_url, headers={"Authorization": f"Bearer {token}"}, timeout=10)
+  # Raise instead of returning an empty map, lru_cache would keep a failed lookup for every benchmark
+  response.raise_for_status()
+
+  # Iterate in reverse so the first warehouse wins when names are duplicated
+  return {warehouse['name']: warehouse['id'] for warehouse in reversed(response.json().get('warehouses', []))}
+
+def get_warehouse(hostname, token, warehouse_name):
+  return list_warehouses(hostname, token).get(warehouse_name)
 
 def update_warehouse(hostname, token, warehouse_id, new_config):
     sql_warehouse_url = f"https://{hostname}/api/2.0/sql/warehouses/{warehouse_id}/edit"
-    response = requests.post(sql_warehouse_url, headers={"Authorization": f"Bearer {token}"}, json=new_config)
+    response = SESSION.post(sql_warehouse_url, headers={"Authorization": f"Bearer {token}"}, json=new_config, timeout=10)
     
     if response.status_code == 200:
         print(f"Warehouse {warehouse_id} updated successfully.")
@@ -182,6 +209,52 @@ def update_warehouse(hostname, token, warehouse_id, new_config):
 
 # COMMAND ----------
 
+def get_queries(bm):
+    """Parse the benchmark queries the same way beaker does in `bm.execute()`"""
+    if bm.query_file_dir is not None:
+        return bm._get_queries_from_dir(bm.query_file_dir)
+    return bm._get_queries_from_file(bm.query_file)
+
+def set_up_connection(bm):
+    """
+    Open a connection to the benchmark warehouse, shared by the warm-up steps and `bm.execute()`.
+
+    Beaker caches one connection per thread in `benchmark.thread_local`, and a pool thread can run several
+    benchmarks in turn. The cached connection is replaced as well, so `bm.preWarmTables()` doesn't send
+    queries to the warehouse of the previous benchmark on this thread.
+    """
+    bm.sql_warehouse = bm._create_dbc()
+    benchmark.thread_local.connection = bm.sql_warehouse
+
+def warm_up_queries(bm, iterations):
+    """
+    Execute each benchmark query `iterations` times before the measured run, at the benchmark concurrency.
+
+    Results are discarded, and the queries run before `bm.execute()` opens its query history window,
+    so they don't show up in the benchmark metrics. Beaker repeats the queries `bm.query_repeat_count` times,
+    so call this before setting the repeat count of the measured run.
+    """
+    queries = get_queries(bm)
+    for i in range(iterations):
+        print(f"Warm-up iteration {i + 1}/{iterations} on {bm.warehouse_name}")
+        bm._execute_queries(queries, bm.concurrency)
+
+def warm_up_plans(bm):
+    """
+    Plan each benchmark query with `EXPLAIN FORMATTED` at the benchmark concurrency,
+    which loads table metadata and statistics without executing it.
+
+    Like `warm_up_queries`, call this before setting the repeat count of the measured run.
+    """
+    print(f"Warming up query plans on {bm.warehouse_name}")
+    bm._execute_queries([(f"EXPLAIN FORMATTED {query}", id) for query, id in get_queries(bm)], bm.concurrency)
+
+def clear_cache(bm):
+    """Clear the cache of the benchmark warehouse"""
+    bm.sql_warehouse.execute_query("CLEAR CACHE")
+
+# COMMAND ----------
+
 def run_benchmark(warehouse_type=warehouse_type, warehouse_size=warehouse_size):
 
     warehouse_name = f"{warehouse_prefix} {warehouse_type} {warehouse_size}"
@@ -211,7 +284,7 @@ def run_benchmark(warehouse_type=warehouse_type, warehouse_size=warehouse_size):
         print(f"--Specify new warehouse `{warehouse_name}`--")
         
 
-    bm = benchmark.Benchmark()
+    bm = ColdBenchmark() if benchmark_mode == "cold" else benchmark.Benchmark()
     bm.setName(f"Benchmark {warehouse_name}")
     bm.setHostname(HOSTNAME)
     bm.setWarehouseToken(TOKEN)
@@ -224,26 +297,97 @@ def run_benchmark(warehouse_type=warehouse_type, warehouse_size=warehouse_size):
 
     bm.setCatalog(catalog_name)
     bm.setSchema(schema_name)
-
-    if disk_cache_enabled:
-        bm.preWarmTables(tables)
     
     bm.query_file_format = "semicolon-delimited"
     bm.setConcurrency(concurrency)
-    bm.setQueryRepeatCount(query_repetition_count)
-    bm.results_cache_enabled = results_cache_enabled
+    # Cold runs must never be served from the result cache
+    bm.results_cache_enabled = results_cache_enabled and benchmark_mode != "cold"
 
     if os.path.isdir(query_path):
         bm.setQueryFileDir(query_path)
     else:
         bm.setQueryFile(query_path)
-    
+
+    # Beaker reads at most 1000 rows of query history without paging, and cold runs add their CLEAR CACHE statements to it
+    if benchmark_mode == "cold":
+        max_history_rows = 2 * len(get_queries(bm)) * query_repetition_count
+        if max_history_rows > 1000:
+            raise ValueError(
+                f"Cold benchmark on `{warehouse_name}` can log up to {max_history_rows} statements in the query history, "
+                "but only 1000 are fetched. Reduce the number of queries or the query repetition count."
+            )
+
+    # Open after the catalog, schema and result cache settings, which the connection picks up
+    set_up_connection(bm)
+
+    if benchmark_mode == "warm":
+        if disk_cache_enabled:
+            bm.preWarmTables(tables)
+        if warmup_plans:
+            warm_up_plans(bm)
+        if warmup_iterations > 0:
+            warm_up_queries(bm, warmup_iterations)
+    elif benchmark_mode == "lukewarm":
+        clear_cache(bm)
+
+    # Set after the warm-up, which would otherwise be repeated as well
+    bm.setQueryRepeatCount(query_repetition_count)
     metrics_pdf = bm.execute()
+    # Drop the cache clearing statements of cold runs from the query history
+    metrics_pdf = metrics_pdf[metrics_pdf["query_text"] != "CLEAR CACHE"]
     # bm.sql_warehouse.close_connection()
     bm.stop_warehouse(bm.warehouse_id)
     return  metrics_pdf
 
 
+def get_max_workers(num_benchmarks):
+    """
+    Number of benchmarks to run at the same time.
+
+    Each benchmark already runs `concurrency` query threads on the driver, so the number of parallel
+    benchmarks shrinks as concurrency grows, with roughly one benchmark per CPU per 10 levels of concurrency.
+    """
+    return max(1, min(num_benchmarks, (os.cpu_count() or 4) // max(1, concurrency // 10)))
+
+def run_benchmarks(benchmark_args):
+    """
+    Run benchmarks concurrently and combine their metrics.
+
+    Parameters:
+    - benchmark_args (list): A list of (warehouse_type, warehouse_size) tuples, one per benchmark.
+
+    Returns:
+    - combined_metrics_pdf (pandas.DataFrame): A Pandas DataFrame containing the combined metrics results from all the benchmarks.
+    """
+
+    # A single benchmark runs inline, without starting a thread pool
+    if len(benchmark_args) == 1:
+        return run_benchmark(*benchmark_args[0])
+
+    # Threads rather than processes: benchmarks spend their time waiting on the warehouses, and run_benchmark
+    # reads notebook state that doesn't cross a process boundary: the widget globals, HOSTNAME, TOKEN, the pooled
+    # SESSION, the cached warehouse list, `tables` and beaker's thread-local warehouse connection
+    with ThreadPoolExecutor(max_workers=get_max_workers(len(benchmark_args))) as executor:
+        futures = {executor.submit(run_benchmark, *args): args for args in benchmark_args}
+        metrics_pdfs = []
+        errors = []
+        for future in as_completed(futures):
+            # Keep the metrics of the other warehouses if one benchmark fails
+            try:
+                metrics_pdfs.append(future.result())
+            except Exception as e:
+                warehouse_type, warehouse_size = futures[future]
+                logger.exception(f"Benchmark on {warehouse_type} {warehouse_size} warehouse failed")
+                errors.append(e)
+
+    if errors and not metrics_pdfs:
+        raise errors[0]
+
+    # Concatenate once rather than growing the combined frame benchmark by benchmark
+    combined_metrics_pdf = pd.concat(metrics_pdfs, ignore_index=True) if metrics_pdfs else pd.DataFrame()
+
+    return combined_metrics_pdf
+
 def run_multiple_benchmarks():
     """
     Run multiple benchmarks for different warehouse types.
@@ -252,19 +396,8 @@ def run_multiple_benchmarks():
     - combined_metrics_pdf (pandas.DataFrame): A Pandas DataFrame containing the combined metrics results from all the benchmarks.
     """
 
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        warehouse_types = ["serverless", "pro", "classic"]
-        futures = [executor.submit(run_benchmark, warehouse_type, warehouse_size) for warehouse_type in warehouse_types]
-        wait(futures, return_when=ALL_COMPLETED)
-    
-    combined_metrics_pdf = pd.DataFrame()
-    for future in futures:
-        if combined_metrics_pdf.empty:
-            combined_metrics_pdf = future.result()
-        else:
-            combined_metrics_pdf = pd.concat([combined_metrics_pdf, future.result()])
-
-    return combined_metrics_pdf
+    warehouse_types = ["serverless", "pro", "classic"]
+    return run_benchmarks([(warehouse_type, warehouse_size) for warehouse_type in warehouse_types])
 
 def run_multiple_benchmarks_size(warehouse_sizes):
     """
@@ -277,18 +410,7 @@ def run_multiple_benchmarks_size(warehouse_sizes):
     - combined_metrics_pdf (pandas.DataFrame): A Pandas DataFrame containing the combined metrics results from all the benchmarks.
     """
 
-    with ThreadPoolExecutor(max_workers=len(warehouse_sizes)) as executor:
-        futures = [executor.submit(run_benchmark, warehouse_type, warehouse_size) for warehouse_size in warehouse_sizes]
-        wait(futures, return_when=ALL_COMPLETED)
-    
-    combined_metrics_pdf = pd.DataFrame()
-    for future in futures:
-        if combined_metrics_pdf.empty:
-            combined_metrics_pdf = future.result()
-        else:
-            combined_metrics_pdf = pd.concat([combined_metrics_pdf, future.result()])
-
-    return combined_metrics_pdf
+    return run_benchmarks([(warehouse_type, warehouse_size) for warehouse_size in warehouse_sizes])
 
 # COMMAND ----------
 
@@ -296,6 +418,31 @@ def run_multiple_benchmarks_size(warehouse_sizes):
 import importlib
 importlib.reload(benchmark)
 
+# Defined after the reload so it subclasses the reloaded Benchmark, like `benchmark.Benchmark()` in run_benchmark
+class ColdBenchmark(benchmark.Benchmark):
+    """
+    Benchmark that clears the cache after every bucket of concurrent queries, so each bucket runs against a cold cache.
+
+    Queries are bucketed by concurrency the same way as in beaker's `_execute_queries`. The cache is cleared once
+    the whole bucket has finished, so it is never cleared while a query of the bucket is still being measured.
+    """
+
+    def _execute_queries(self, queries, num_threads):
+        queries = queries * self.query_repeat_count
+        metrics_list = []
+        for i in range(0, len(queries), num_threads):
+            query_bucket = queries[i:i + num_threads]
+            print(f"Executing {len(query_bucket)} queries concurrently on {self.warehouse_name}")
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                futures = [executor.submit(self._execute_single_query, query, id) for query, id in query_bucket]
+            metrics_list += [future.result() for future in futures]
+            self.sql_warehouse.execute_query("CLEAR CACHE")
+        return metrics_list
+
+# Refresh the warehouse list once before fanning out, previous runs may have created new warehouses
+list_warehouses.cache_clear()
+list_warehouses(HOSTNAME, TOKEN)
+
 # logger = logging.getLogger()
 # logger.setLevel(logging.INFO)
 
@@ -315,12 +462,99 @@ elif benchmark_choice == "multiple-warehouses-size":
 
 # COMMAND ----------
 
+_ARROW_TYPES = {int: pa.int64(), float: pa.float64(), bool: pa.bool_(), str: pa.string()}
+
+def get_metrics_schema():
+    """
+    Arrow struct of the scalar Query History metrics, built from the SDK's `QueryMetrics` so it follows the API.
+
+    Returns the struct and the names of the nested metrics (such as `task_time_over_time_range`) left out of it.
+    """
+    type_hints = get_type_hints(QueryMetrics)
+    scalar_fields, nested_names = [], []
+    for field in fields(QueryMetrics):
+        # Metrics are declared as Optional[...], use the wrapped type
+        field_type = next((t for t in get_args(type_hints[field.name]) if t is not type(None)), type_hints[field.name])
+        if field_type in _ARROW_TYPES:
+            scalar_fields.append((field.name, _ARROW_TYPES[field_type]))
+        else:
+            nested_names.append(field.name)
+    return pa.struct(scalar_fields), nested_names
+
+METRICS_SCHEMA, NESTED_METRICS = get_metrics_schema()
+
+def clean_metrics(metrics_pdf):
+    """
+    Flatten the `metrics` column of the query history into one column per metric.
+
+    Used by the result table and the chart, which needs `total_time_ms` as a column. The Lakeview
+    Delta table keeps the raw `metrics` struct. Metrics read back as JSON strings are parsed once
+    with `json.loads`. Queries without metrics get empty values.
+
+    The dicts are converted into a pyarrow struct array of `METRICS_SCHEMA` and split into its fields,
+    so no per-row schema inference is needed. Nested metrics are kept as-is in their own columns.
+    If a metric doesn't match its declared type, the metrics are flattened with `json_normalize` instead.
+    """
+    metrics = metrics_pdf["metrics"]
+    # Check the type once on the first non-null value instead of converting every row
+    sample = metrics.dropna().iloc[0] if metrics.notna().any() else None
+    if isinstance(sample, str):
+        records = [json.loads(m) for m in metrics.fillna("{}")]
+    else:
+        records = [m if isinstance(m, dict) else {} for m in metrics]
+    try:
+        metrics_arr = pa.array(records, type=METRICS_SCHEMA)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        logger.warning("Query metrics don't match the QueryMetrics schema, inferring the metric columns instead")
+        metrics_clean_pdf = pd.json_normalize(records)
+    else:
+        metrics_clean_pdf = pa.Table.from_arrays(
+            metrics_arr.flatten(), names=[field.name for field in metrics_arr.type]
+        ).to_pandas()
+        for name in NESTED_METRICS:
+            metrics_clean_pdf[name] = [m.get(name) for m in records]
+    return pd.concat(
+        [metrics_pdf[["id", "warehouse_name", "query_id", "query_text"]].reset_index(drop=True), metrics_clean_pdf],
+        axis=1,
+    )
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC Below graph shows average duration of all queries in the warehouse history from start to end of benchmark, broken down by warehouses
 
 # COMMAND ----------
 
-display(metrics_pdf)
+metrics_clean_pdf = clean_metrics(metrics_pdf)
+
+# Group on categorical codes, only over observed combinations and without sorting the keys
+for c in ("id", "warehouse_name"):
+    metrics_clean_pdf[c] = metrics_clean_pdf[c].astype("category")
+grouped_metrics = (
+    metrics_clean_pdf.groupby(["id", "warehouse_name"], observed=True, sort=False)["total_time_ms"]
+    .mean()
+    .reset_index()
+)
+
+# Without sorted group keys, order the bars like the queries in the query files
+query_bm = benchmark.Benchmark()
+query_bm.query_file_format = "semicolon-delimited"
+if os.path.isdir(query_path):
+    query_bm.setQueryFileDir(query_path)
+else:
+    query_bm.setQueryFile(query_path)
+observed_ids = set(grouped_metrics["id"])
+query_ids = [id for id in dict.fromkeys(id for _, id in get_queries(query_bm)) if id in observed_ids]
+
+fig = px.bar(
+    grouped_metrics, x="id", y="total_time_ms", color="warehouse_name", barmode="group",
+    category_orders={"id": query_ids}, title="Query Metrics by Warehouse",
+)
+fig.show()
+
+# COMMAND ----------
+
+display(metrics_clean_pdf)
 
 # COMMAND ----------
 
@@ -395,9 +629,13 @@ metrics_sdf = (
                   .withColumn("concurrency", lit(concurrency))
                   .withColumn("benchmark_catalog", lit(catalog_name))
                   .withColumn("benchmark_schema", lit(schema_name))
+                  .withColumn("benchmark_mode", lit(benchmark_mode))
+                  .withColumn("warmup_iterations", lit(warmup_iterations))
+                  .withColumn("warmup_plans", lit(warmup_plans))
                   .selectExpr("current_timestamp() as run_timestamp", "concurrency", 
+                              "benchmark_mode", "warmup_iterations", "warmup_plans",
                               "id", "warehouse_name", "benchmark_catalog", "benchmark_schema",
-                              "* except(id, warehouse_name, concurrency, benchmark_catalog, benchmark_schema)")
+                              "* except(id, warehouse_name, concurrency, benchmark_catalog, benchmark_schema, benchmark_mode, warmup_iterations, warmup_plans)")
 )
 display(metrics_sdf)
 